@@ -149,7 +149,10 @@ class TextProcessor:
         self.logger = logging.get_logger(self.task.upper())
         self.logger.debug(f"Got config:\n{self.cfg}")
 
-        torch.set_num_threads(len(os.sched_getaffinity(0)))
+        # cache the cpu count, os.sched_getaffinity is a syscall
+        # and _process might be called frequently
+        self._num_cpus = len(os.sched_getaffinity(0))
+        torch.set_num_threads(self._num_cpus)
         torch.use_deterministic_algorithms(False)
         cudnn.benchmark = True
         cuda.matmul.allow_tf32 = True
@@ -173,7 +176,7 @@ class TextProcessor:
         **kwargs: Any,
     ) -> Iterator[Any]:
         if num_threads is None:
-            num_threads = min(len(os.sched_getaffinity(0)), 4)
+            num_threads = min(self._num_cpus, 4)
 
         if batch_max_tokens is None:
             batch_limit = max(1, batch_size)
@@ -223,12 +226,16 @@ class TextProcessor:
 
                     results[item.item_idx][item.window_idx] = (item, output)
 
-            outputs = []
-            for item_idx in range(len(results)):
+            num_items = len(results)
+            for item_idx in range(num_items):
+                # pop the windows so each item is freed as soon
+                # as it is yielded instead of holding on to all
+                # results until the generator is exhausted
+                windows = results.pop(item_idx)
                 window_items = []
                 window_outputs = []
-                for window_idx in range(len(results[item_idx])):
-                    item, output = results[item_idx][window_idx]
+                for window_idx in range(len(windows)):
+                    item, output = windows[window_idx]
                     window_items.append(item)
                     window_outputs.append(output)
 
@@ -1,5 +1,4 @@
 import os
-import math
 from typing import List, Optional, Set, Tuple
 
 import torch
@@ -40,17 +39,35 @@ def generate_table(
     if len(highlight) > 0 and highlight_type == "markdown":
         max_column_width += 4
 
+    # precompute highlight membership once instead of testing
+    # (i, j) in highlight for both the column widths and the rows below;
+    # rows without highlights share a single all-False list so the
+    # materialization stays proportional to the highlighted rows
+    no_highlight = [False] * columns
+    highlight_rows = {i for i, _ in highlight}
+    highlight_cells = [
+        [(i, j) in highlight for j in range(columns)]
+        if i in highlight_rows else no_highlight
+        for i in range(rows)
+    ]
+    markdown_highlight = highlight_type == "markdown"
+
+    # measure each cell only once, lengths are reused for the
+    # column widths and when rendering the rows
+    header_lens = [[len(c) for c in h] for h in headers] if headers else []
+    data_lens = [[len(c) for c in d] for d in data]
+
     # get max width for each column in headers and data
     column_widths = []
     for i in range(columns):
         # add 4 to width if cell is bold because of the two **s left and right
-        header_width = max(len(h[i]) for h in headers) if headers else 0
+        header_width = max(h[i] for h in header_lens) if headers else 0
         data_width = max(
             min(
                 max_column_width,
-                len(d[i]) + (4 * ((j, i) in highlight and highlight_type == "markdown"))
+                d[i] + (4 * (highlight_cells[j][i] and markdown_highlight))
             )
-            for j, d in enumerate(data)
+            for j, d in enumerate(data_lens)
         )
         column_widths.append(
             min(
@@ -67,25 +84,22 @@ def generate_table(
     if horizontal_lines is None:
         horizontal_lines = [0] * len(data)
 
-    highlight_cells = [
-        [(i, j) in highlight for j in range(len(data[i]))]
-        for i in range(len(data))
-    ]
-
     tables_lines = []
 
     if headers is not None:
         assert all(len(h) == columns for h in headers), \
             f"all headers must have {columns} columns"
         tables_lines.extend([
-            _table_row(header, [False] * columns, highlight_type,
+            _table_row(header, header_lens[i], [False] * columns, highlight_type,
                        highlight_color, alignments, column_widths, max_column_width)
             + (_table_horizontal_line(column_widths) if i == len(headers) - 1 else "")
             for i, header in enumerate(headers)
         ])
 
-    for item, horizontal_line, bold in zip(data, horizontal_lines, highlight_cells):
-        line = _table_row(item, bold, highlight_type, highlight_color,
+    for item, lens, horizontal_line, bold in zip(
+        data, data_lens, horizontal_lines, highlight_cells
+    ):
+        line = _table_row(item, lens, bold, highlight_type, highlight_color,
                           alignments, column_widths, max_column_width)
         if horizontal_line > 0:
             line += _table_horizontal_line(column_widths)
@@ -95,13 +109,20 @@ def generate_table(
 
 
 def _table_cell(s: str, alignment: str, width: int) -> str:
-    if alignment == "left":
-        s = s.ljust(width)
+    # manual padding is faster than str.ljust/rjust/center
+    # since this is called once per cell
+    pad = width - len(s)
+    if pad <= 0:
+        return s
+    elif alignment == "left":
+        return s + " " * pad
     elif alignment == "right":
-        s = s.rjust(width)
+        return " " * pad + s
     else:
-        s = s.center(width)
-    return s
+        # match str.center exactly: it puts the extra space of odd
+        # padding on the left or right depending on width parity
+        left = pad // 2 + (pad & width & 1)
+        return " " * left + s + " " * (pad - left)
 
 
 def _highlight(s: str, hcolor: str) -> str:
@@ -110,6 +131,7 @@ def _highlight(s: str, hcolor: str) -> str:
 
 def _table_row(
     data: List[str],
+    lengths: List[int],
     highlight: List[bool],
     highlight_type: str,
     highlight_color: str,
@@ -117,21 +139,40 @@ def _table_row(
     widths: List[int],
     max_width: int
 ) -> str:
-    num_lines = [math.ceil(len(d) / max_width) for d in data]
+    # ceil division in pure int arithmetic
+    num_lines = [-(-length // max_width) for length in lengths]
     max_num_lines = max(num_lines)
+    # hoist per-column invariants out of the sub-line loop, the loop
+    # body then only slices and pads
+    markdown = highlight_type == "markdown"
+    columns = [
+        (d, h and markdown, h and not markdown, a, w)
+        for d, h, a, w in zip(data, highlight, alignments, widths)
+    ]
+    any_highlight = any(highlight)
     lines = []
     for i in range(max_num_lines):
-        line_data = [d[i*max_width: (i + 1) * max_width] for d in data]
-        cells = []
-        for d, h, a, w in zip(line_data, highlight, alignments, widths):
-            if h and highlight_type == "markdown":
-                cell = _table_cell(f"**{d}**", a, w)
-            elif h and highlight_type == "terminal":
-                cell = _highlight(_table_cell(d, a, w), highlight_color)
-            else:
-                cell = _table_cell(d, a, w)
-            cells.append(cell)
-        lines.append("| " + " | ".join(cells) + " |")
+        start = i * max_width
+        end = start + max_width
+        if not any_highlight:
+            # fast path for rows without highlighted cells, a single
+            # comprehension without per-cell branching
+            cells = [
+                _table_cell(d[start:end], a, w)
+                for d, _, _, a, w in columns
+            ]
+        else:
+            cells = []
+            for d, bold, color, a, w in columns:
+                d = d[start:end]
+                if bold:
+                    cell = _table_cell(f"**{d}**", a, w)
+                elif color:
+                    cell = _highlight(_table_cell(d, a, w), highlight_color)
+                else:
+                    cell = _table_cell(d, a, w)
+                cells.append(cell)
+        lines.append(f"| {' | '.join(cells)} |")
     return "\n".join(lines)
 
 
@@ -139,6 +180,13 @@ def _table_horizontal_line(widths: List[int]) -> str:
     return "\n| " + " | ".join("-" * w for w in widths) + " |"
 
 
+_PRECISION_STR = {
+    torch.float16: "fp16",
+    torch.bfloat16: "bfp16",
+    torch.float32: "fp32",
+}
+
+
 def generate_report(
     task: str,
     model_name: str,
@@ -156,16 +204,18 @@ def generate_report(
     if precision is None:
         precision = next(model.parameters()).dtype
 
-    if precision == torch.float16:
-        precision_str = "fp16"
-    elif precision == torch.bfloat16:
-        precision_str = "bfp16"
-    elif precision == torch.float32:
-        precision_str = "fp32"
-    else:
-        precision_str = str(precision)
+    precision_str = _PRECISION_STR.get(precision) or str(precision)
 
     devices = [d for d in devices if d.type == "cuda"]
+    # query the cuda memory stats once up front and only
+    # for actual cuda devices, cpu-only runs never touch the cuda runtime
+    if devices:
+        gpu_memory = ", ".join(
+            f"{torch.cuda.max_memory_reserved(d) // 1024 ** 2:,} MiB"
+            for d in devices
+        )
+    else:
+        gpu_memory = "n/a"
     devices.append(torch.device("cpu"))
     report = generate_table(
         headers=[["REPORT", task]],
@@ -176,11 +226,7 @@ def generate_report(
             ["Runtime", f"{runtime:,.1f} s"],
             ["Throughput 1", f"{input_size / runtime:,.1f} Seq/s"],
             ["Throughput 2", f"{input_size_bytes / runtime / 1000:,.1f} kB/s"],
-            ["GPU memory", ", ".join(
-                f"{torch.cuda.max_memory_reserved(d) // 1024 ** 2:,} MiB"
-                for d in devices
-                if d.type == "cuda"
-            )],
+            ["GPU memory", gpu_memory],
             ["Parameters", f"{utils.num_parameters(model)['total'] / 1000 ** 2:,.1f} M"],
             ["Precision", precision_str],
             ["Batch size", f"{batch_size:,}"] if batch_max_tokens is None else
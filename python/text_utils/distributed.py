@@ -2,6 +2,7 @@ from typing import Any
 
 import torch
 from torch import nn, optim
+from torch.distributed.algorithms.ddp_comm_hooks import default_hooks
 from torch.distributed.fsdp.fully_sharded_data_parallel import FullyShardedDataParallel as FSDP
 from torch.nn.parallel import DistributedDataParallel as DDP
 
@@ -18,14 +19,15 @@ class DistributedInfo:
         self.local_rank = local_rank
         self.world_size = world_size
         self.local_world_size = local_world_size
-        if torch.cuda.device_count() == local_world_size:
+        num_devices = torch.cuda.device_count()
+        if num_devices == local_world_size:
             device_index = self.local_rank
-        elif torch.cuda.device_count() == 1:
+        elif num_devices == 1:
             device_index = 0
         else:
             raise RuntimeError(
                 f"expected either {local_world_size} or 1 GPUs available, "
-                f"but got {torch.cuda.device_count()} GPUs instead"
+                f"but got {num_devices} GPUs instead"
             )
         self.device = torch.device(device_index)
 
@@ -45,6 +47,33 @@ class DistributedInfo:
     def is_main_process(self) -> bool:
         return self.rank == 0
 
+    def wrap_ddp(
+        self,
+        model: nn.Module,
+        bucket_cap_mb: int = 25,
+        compress: str | None = None
+    ) -> DDP:
+        """
+        Wraps the model in DistributedDataParallel on this process's device.
+        bucket_cap_mb controls the gradient bucketing granularity; larger
+        buckets reduce the number of all-reduces, smaller buckets overlap
+        better with the backward pass. compress can be set to "fp16" or
+        "bf16" to register a gradient compression hook, halving the
+        all-reduce bandwidth at high world sizes.
+        """
+        assert compress is None or compress in {"fp16", "bf16"}, \
+            f"compress must be None, 'fp16' or 'bf16', but got {compress}"
+        model = DDP(
+            model,
+            device_ids=[self.device.index],
+            bucket_cap_mb=bucket_cap_mb
+        )
+        if compress == "fp16":
+            model.register_comm_hook(None, default_hooks.fp16_compress_hook)
+        elif compress == "bf16":
+            model.register_comm_hook(None, default_hooks.bf16_compress_hook)
+        return model
+
     def __repr__(self) -> str:
         return f"DistributedDevice(rank={self.rank}, local_rank={self.local_rank}, " \
             f"world_size={self.world_size}, local_world_size={self.local_world_size}, " \
@@ -1,7 +1,10 @@
+import heapq
+import itertools
+import math
 from typing import Any, Iterator
 
+import numpy as np
 import torch
-from torch.nn.utils import rnn
 
 from text_utils.inference.utils import (
     DecodeFn,
@@ -13,6 +16,7 @@ from text_utils.inference.utils import (
     UpdateFn,
     StopFn,
     ScoreFn,
+    LogLikelihoodScore,
     identity_update_fn,
     log_likelihood_score,
     greedy,
@@ -34,8 +38,14 @@ def beam_search(
     logit_fns: list[LogitFn] | None = None,
     kwargs_select_fn: MaskSelectFn | None = None,
     kwargs_update_fn: MaskUpdateFn | None = None,
+    cache: bool = False,
     stop_condition: str = "estimated_score",
     max_new_tokens: int | None = None,
+    relative_threshold: float | None = None,
+    absolute_threshold: float | None = None,
+    max_candidates_per_node: int | None = None,
+    length_bucket_size: int | None = None,
+    autocast_dtype: torch.dtype | None = None,
     return_incomplete: bool = False,
     yield_intermediate: bool = False,
     **kwargs: Any,
@@ -48,6 +58,24 @@ def beam_search(
         "estimated_score",
         "max_outputs",
     }, "stop condition must be 'max_score', 'estimated_score' or 'max_outputs'"
+    assert (
+        relative_threshold is None or 0.0 < relative_threshold <= 1.0
+    ), "relative_threshold must be in (0, 1]"
+    assert (
+        absolute_threshold is None or absolute_threshold >= 0.0
+    ), "absolute_threshold must be non-negative"
+    assert (
+        max_candidates_per_node is None or max_candidates_per_node > 0
+    ), "max_candidates_per_node must be None or positive"
+    assert (
+        length_bucket_size is None or length_bucket_size > 0
+    ), "length_bucket_size must be None or positive"
+    assert (
+        autocast_dtype is None or autocast_dtype.is_floating_point
+    ), "autocast_dtype must be None or a floating point dtype"
+    assert (
+        not cache or kwargs_update_fn is not None
+    ), "cache requires a kwargs_update_fn that reorders the cached state"
     batch_size = len(initial)
 
     decoder_info: Any | None = None
@@ -55,6 +83,11 @@ def beam_search(
     current_beams: list[list[Beam]] = []
     finished_beams: list[list[Beam]] = []
     too_long_beams: list[list[Beam]] = []
+    # decode row each active beam's parent occupied in the previous
+    # step's decoder batch, kept in sync with current_beams so caching
+    # decode_fns can reorder their state; values are meaningless until
+    # the first decoder call happened
+    parent_rows: list[list[int]] = []
 
     for init in initial:
         if isinstance(init, Beam):
@@ -70,24 +103,44 @@ def beam_search(
 
         current_beams.append(beams)  # type: ignore
         update_info.append(len(beams))
+        parent_rows.append([0] * len(beams))
         finished_beams.append([])
         too_long_beams.append([])
 
+    # hoisted out of filter_beams, without a limit on new tokens
+    # only the total length can stop a beam
+    max_decoded_tokens = max_new_tokens or float("inf")
+
+    def cached_score(beam: Beam) -> float:
+        return beam.score(score_fn)
+
+    # for beams of equal decoded length, scores that are monotone in the
+    # decoded log prob rank candidates the same way the plain log prob
+    # sums do; whether the lengths are equal is checked per batch element
+    # each step, since user-built initial beams may mix initial lengths
+    # (every step extends all active beams by exactly one token, so a
+    # difference neither appears nor disappears during decoding)
+    monotone_score = getattr(score_fn, "monotone_in_log_prob", False)
+
     def filter_beams() -> bool:
         finished = True
         for idx in range(batch_size):
             new_beams = []
-            for beam in current_beams[idx]:
+            new_rows = []
+            for beam, row in zip(current_beams[idx], parent_rows[idx]):
                 if stop_fn(beam):
                     finished_beams[idx].append(beam)
-                elif len(beam) >= max_length or beam.decoded_length >= (
-                    max_new_tokens or (beam.decoded_length + 1)
+                elif (
+                    len(beam) >= max_length
+                    or beam.decoded_length >= max_decoded_tokens
                 ):
                     too_long_beams[idx].append(beam)
                 else:
                     new_beams.append(beam)
+                    new_rows.append(row)
 
             current_beams[idx] = new_beams
+            parent_rows[idx] = new_rows
             if not current_beams[idx]:
                 # we are done with this batch element
                 continue
@@ -100,15 +153,17 @@ def beam_search(
                 # we are done with this batch element
                 # because we have enough finished beams
                 current_beams[idx] = []
+                parent_rows[idx] = []
                 continue
 
             worst_finished = min(
-                (score_fn(b) for b in finished_beams[idx]), default=float("-inf")
+                (cached_score(b) for b in finished_beams[idx]),
+                default=float("-inf")
             )
             if stop_condition == "estimated_score":
                 # best current calculated from current length
                 # idea: is a current active beam better than the worst finished beam?
-                best_current = max(score_fn(b) for b in current_beams[idx])
+                best_current = max(cached_score(b) for b in current_beams[idx])
             else:
                 # best current calculated from maximum length
                 # idea: assume all remaining tokens are perfectly predicted
@@ -122,6 +177,7 @@ def beam_search(
             if worst_finished >= best_current:
                 # set current beams to empty list to stop processing
                 current_beams[idx] = []
+                parent_rows[idx] = []
             else:
                 finished = False
 
@@ -144,39 +200,131 @@ def beam_search(
             else:
                 beams = finished
 
-            beams = sorted(beams, key=score_fn, reverse=True)
-            outputs.append(beams[:beam_width])
+            # only the best beam_width beams are returned,
+            # no need to sort the rest
+            if isinstance(score_fn, LogLikelihoodScore):
+                # one vectorized scoring pass instead of a Python call
+                # per beam; the stable argsort keeps ties in beam order
+                # just like nlargest
+                scores = score_fn.batch(beams)
+                top = np.argsort(-scores, kind="stable")[:beam_width]
+                outputs.append([beams[i] for i in top])
+            else:
+                outputs.append(
+                    heapq.nlargest(beam_width, beams, key=cached_score)
+                )
 
         return outputs
 
+    # reusable host-side buffer for the padded token ids, pinned so the
+    # non_blocking copy to the device can overlap with compute; reusing
+    # it across steps is safe because .to() materializes a new device
+    # tensor each step and each step syncs with the device when moving
+    # the sampled candidates back to the host. on cpu .to() is a no-op
+    # that would hand the decode_fn a view of the buffer itself, so
+    # buffers are only reused when the target is an actual cuda device
+    reuse_buffers = device.type == "cuda"
+    padded_token_ids = torch.empty(0, dtype=torch.long)
+    update_mask_buffer = torch.empty(0, dtype=torch.long)
+
     while not filter_beams():
         num_beams = []
         beams = []
-        decoder_mask = []
         decoder_token_ids = []
         decoder_lengths = []
         for idx in range(batch_size):
             num = len(current_beams[idx])
             num_beams.append(num)
-            decoder_mask.extend([idx] * num)
             for beam in current_beams[idx]:
                 beams.append(beam)
                 decoder_lengths.append(len(beam))
-                decoder_token_ids.append(torch.tensor(beam.token_ids, dtype=torch.long))
-
-        decoder_token_ids = rnn.pad_sequence(
-            decoder_token_ids, batch_first=True, padding_value=pad_token_id
-        ).to(non_blocking=True, dtype=torch.long, device=device)
-        decoder_mask = torch.tensor(decoder_mask, dtype=torch.long)
+                decoder_token_ids.append(beam.ids_tensor())
+
+        num = len(beams)
+        # caching is an explicit opt-in: only then does the decode_fn
+        # promise to keep per-beam state over the prefix and to reorder
+        # it in its kwargs_update_fn based on the parent rows below
+        use_cache = cache and decoder_info is not None
+        if use_cache:
+            # the decode_fn maintains a cache over the prefix, so only the
+            # newest token per beam needs to be passed; lengths still
+            # reflect the full sequences so positions stay correct (note
+            # that logit_fns consequently also only see the newest token)
+            if not reuse_buffers:
+                buffer = torch.empty(num, 1, dtype=torch.long)
+            else:
+                if padded_token_ids.numel() < num:
+                    padded_token_ids = torch.empty(
+                        num, dtype=torch.long, pin_memory=True
+                    )
+                buffer = padded_token_ids[:num].view(num, 1)
+            buffer[:, 0] = torch.tensor(
+                [beam.token_ids[-1] for beam in beams], dtype=torch.long
+            )
+            decoder_token_ids = buffer.to(device, non_blocking=True)
+        else:
+            max_len = max(decoder_lengths)
+            if length_bucket_size is not None:
+                # round the padded length up to the next bucket so compiled
+                # or graph-captured decode_fns see fewer distinct shapes;
+                # the extra positions are regular padding beyond lengths
+                max_len = min(
+                    -(-max_len // length_bucket_size) * length_bucket_size,
+                    max_length
+                )
+            if not reuse_buffers:
+                buffer = torch.empty(num, max_len, dtype=torch.long)
+            else:
+                if padded_token_ids.numel() < num * max_len:
+                    padded_token_ids = torch.empty(
+                        num * max_len, dtype=torch.long, pin_memory=True
+                    )
+                buffer = padded_token_ids[:num * max_len].view(num, max_len)
+            buffer.fill_(pad_token_id)
+            for i, token_ids in enumerate(decoder_token_ids):
+                buffer[i, :len(token_ids)] = token_ids
+            decoder_token_ids = buffer.to(device, non_blocking=True)
+        # np.repeat builds the batch index masks in a single C call and
+        # torch.from_numpy wraps the buffer without copying, keeping this
+        # off the Python critical path before the decoder launch
+        decoder_mask = torch.from_numpy(
+            np.repeat(np.arange(batch_size, dtype=np.int64), num_beams)
+        )
         decoder_lengths_tensor = torch.tensor(decoder_lengths, dtype=torch.long)
 
         if kwargs_update_fn is not None and decoder_info is not None:
-            update_mask = []
-            for idx in range(batch_size):
-                update_mask.extend([idx] * update_info[idx])
-            kwargs_update_fn(
-                kwargs, decoder_info, torch.tensor(update_mask, dtype=torch.long)
-            )
+            if use_cache:
+                # with caching the mask holds, for every beam in this
+                # step's batch order, the decode row its parent occupied
+                # in the previous step's batch (rebuilt after filtering,
+                # so culled beams and finished batch elements are already
+                # dropped); an update fn can index_select per-beam caches
+                # with it directly
+                upd = np.asarray(
+                    [row for rows in parent_rows for row in rows],
+                    dtype=np.int64,
+                )
+            else:
+                # without caching keep the original contract, the batch
+                # element index per beam selected in the last step
+                upd = np.repeat(
+                    np.arange(batch_size, dtype=np.int64), update_info
+                )
+            # hand the update fn a device tensor; on cuda the mask is
+            # staged through a reusable pinned buffer like the token ids,
+            # on cpu the fresh array is passed directly so the update fn
+            # never sees a reused buffer
+            if reuse_buffers:
+                if update_mask_buffer.numel() < len(upd):
+                    update_mask_buffer = torch.empty(
+                        len(upd), dtype=torch.long, pin_memory=True
+                    )
+                update_mask = update_mask_buffer[:len(upd)]
+                update_mask.copy_(torch.from_numpy(upd))
+                update_mask = update_mask.to(device, non_blocking=True)
+            else:
+                update_mask = torch.from_numpy(upd)
+            kwargs_update_fn(kwargs, decoder_info, update_mask)
 
         if kwargs_select_fn is not None:
             decoder_kwargs = kwargs_select_fn(kwargs, decoder_mask)
@@ -185,44 +333,192 @@ def beam_search(
         # lengths are added automatically, do not provide them yourself"
         decoder_kwargs["lengths"] = decoder_lengths_tensor
 
-        decoder_outputs, decoder_info = decode_fn(decoder_token_ids, **decoder_kwargs)
-        b, s, _ = decoder_outputs.shape
+        # running the decoder under autocast halves the bytes moved per
+        # weight for fp32 models, which is where most of the decode step
+        # time goes for memory-bound models; the scores are cast back to
+        # fp32 below so the log softmax and pruning stay numerically safe
+        with torch.autocast(
+            device_type=device.type,
+            dtype=autocast_dtype,
+            enabled=autocast_dtype is not None,
+        ):
+            decoder_outputs, decoder_info = decode_fn(
+                decoder_token_ids, **decoder_kwargs
+            )
+        if autocast_dtype is not None:
+            decoder_outputs = decoder_outputs.float()
+        b, s, v = decoder_outputs.shape
         if s == 1:
             decoder_outputs = decoder_outputs[:, 0]
         else:
-            decoder_outputs = decoder_outputs[
-                torch.arange(b), decoder_lengths_tensor - 1
-            ]
-
-        raw_log_probs = torch.log_softmax(decoder_outputs, dim=-1)
+            # gather the outputs at the last non-padded position, avoids
+            # allocating an arange index tensor every step
+            index = (decoder_lengths_tensor - 1).to(decoder_outputs.device)
+            decoder_outputs = decoder_outputs.gather(
+                1, index.view(-1, 1, 1).expand(-1, 1, v)
+            ).squeeze(1)
 
-        # apply logit functions
-        for logit_fn in logit_fns or []:
-            decoder_outputs = logit_fn(decoder_token_ids, decoder_outputs, beams)
+        if logit_fns:
+            raw_log_probs = torch.log_softmax(decoder_outputs, dim=-1)
 
-        log_probs = torch.log_softmax(decoder_outputs, dim=-1)
+            # apply logit functions
+            for logit_fn in logit_fns:
+                decoder_outputs = logit_fn(decoder_token_ids, decoder_outputs, beams)
 
-        raw_log_probs = torch.split(raw_log_probs, num_beams)
-        log_probs = torch.split(log_probs, num_beams)
-        for idx, (raw_log_prob, log_prob) in enumerate(zip(raw_log_probs, log_probs)):
-            candidates: list[Beam] = []
-            for beam_idx, beam in enumerate(current_beams[idx]):
-                for token_id in sample_fn(log_prob[beam_idx], beam_width).tolist():
-                    candidate = beam.clone()
-                    candidate.add(token_id, raw_log_prob[beam_idx, token_id].item())
-                    candidates.append(candidate)
+            log_probs = torch.log_softmax(decoder_outputs, dim=-1)
+        else:
+            # without logit functions the raw and processed distributions
+            # are identical, a single softmax kernel suffices
+            raw_log_probs = log_probs = torch.log_softmax(decoder_outputs, dim=-1)
+
+        # sample candidate tokens for all beams in one call and move them
+        # to the host in one transfer, instead of forcing a device sync
+        # per candidate via .item()
+        sampled = sample_fn(log_probs, beam_width)
+        num_per_beam = sampled.shape[1]
+        sampled_rows = torch.arange(
+            len(beams), device=sampled.device
+        ).repeat_interleave(num_per_beam)
+        sampled_ids = sampled.flatten()
+        sampled_log_probs = raw_log_probs[sampled_rows, sampled_ids]
+
+        # sample_fn may return tokens with -inf log prob, either masked
+        # by a logit fn or emitted as -inf by the decode_fn itself;
+        # always drop them on the device so they never become candidates
+        if logit_fns:
+            keep = torch.isfinite(log_probs[sampled_rows, sampled_ids])
+        else:
+            keep = torch.isfinite(sampled_log_probs)
+
+        if relative_threshold is not None or absolute_threshold is not None:
+            # prune candidates that fall too far behind the best candidate
+            # of their batch element, so only survivors cross to the host;
+            # relative_threshold is a factor in probability space,
+            # absolute_threshold a log prob difference
+            # (already invalidated candidates must not define the best)
+            valid_log_probs = sampled_log_probs.masked_fill(
+                ~keep, float("-inf")
+            )
+            if batch_size == 1:
+                # single batch element, all candidates compare against
+                # the same best, no scatter or index mapping needed;
+                # this is the common interactive decoding case
+                best = valid_log_probs.max()
+            else:
+                candidate_batch = decoder_mask.to(
+                    sampled_rows.device
+                )[sampled_rows]
+                best = torch.full(
+                    (batch_size,), float("-inf"), device=sampled_log_probs.device
+                )
+                best.scatter_reduce_(
+                    0, candidate_batch, valid_log_probs, reduce="amax"
+                )
+                best = best[candidate_batch]
+            if relative_threshold is not None:
+                keep &= sampled_log_probs >= best + math.log(relative_threshold)
+            if absolute_threshold is not None:
+                keep &= sampled_log_probs >= best - absolute_threshold
+
+        sampled_rows = sampled_rows[keep]
+        sampled_ids = sampled_ids[keep]
+        sampled_log_probs = sampled_log_probs[keep]
+        num_sampled = torch.bincount(
+            sampled_rows, minlength=len(beams)
+        ).tolist()
+
+        sampled_log_probs = sampled_log_probs.tolist()
+        sampled_ids = sampled_ids.tolist()
+
+        offsets = [0, *itertools.accumulate(num_sampled)]
+
+        beam_offset = 0
+        for idx in range(batch_size):
+            parent_beams = current_beams[idx]
+            # decode row of this element's first beam in the current
+            # step's batch, accepted candidates record their parent's
+            # row relative to it for the cache reorder mask
+            row_offset = beam_offset
+
+            start = offsets[beam_offset]
+            end = offsets[beam_offset + num_beams[idx]]
+            counts = num_sampled[beam_offset:beam_offset + num_beams[idx]]
+
+            # the fast path is only exact if all parents share one decoded
+            # length, normalized scores divide by different lengths otherwise
+            equal_lengths = monotone_score and len(
+                {beam.decoded_length for beam in parent_beams}
+            ) <= 1
+
+            if equal_lengths:
+                # rank candidates by the parent log prob plus the sampled
+                # token log prob and clone only the accepted ones below,
+                # instead of materializing a Beam per candidate; scores
+                # and ranking stay in numpy, the stable argsort keeps
+                # ties in sampling order (argpartition would be cheaper
+                # but the per-parent cap below needs the full order)
+                parent_of = np.repeat(np.arange(num_beams[idx]), counts)
+                scores = np.asarray(sampled_log_probs[start:end])
+                scores += np.repeat(
+                    [beam.decoded_log_prob for beam in parent_beams], counts
+                )
+                order = np.argsort(-scores, kind="stable")
+                ranked = np.stack(
+                    [order + start, parent_of[order]], axis=1
+                ).tolist()
+            else:
+                # custom score functions may order candidates arbitrarily
+                # and mixed decoded lengths break the monotonicity
+                # argument, fall back to scoring fully built candidates
+                built: list[Beam] = []
+                parents: list[int] = []
+                for beam_idx, beam in enumerate(parent_beams):
+                    for i in range(
+                        offsets[beam_offset + beam_idx],
+                        offsets[beam_offset + beam_idx + 1],
+                    ):
+                        candidate = beam.clone()
+                        candidate.add(sampled_ids[i], sampled_log_probs[i])
+                        built.append(candidate)
+                        parents.append(beam_idx)
+                ranked = [
+                    (i, parent)
+                    for _, i, parent in sorted(
+                        (-candidate.score(score_fn), i, parents[i])
+                        for i, candidate in enumerate(built)
+                    )
+                ]
+            beam_offset += num_beams[idx]
+
+            # cap how many candidates may descend from the same parent
+            # beam to keep diversity in the next beam
+            per_parent = [0] * num_beams[idx]
+            max_per_parent = max_candidates_per_node or len(ranked)
 
             # reset current beams and fill with best candidates
             current_beams[idx] = []
-            for candidate in sorted(candidates, key=score_fn, reverse=True):
+            parent_rows[idx] = []
+            for i, parent in ranked:
+                if per_parent[parent] >= max_per_parent:
+                    # too many candidates from the same parent
+                    continue
+
+                if equal_lengths:
+                    candidate = parent_beams[parent].clone()
+                    candidate.add(sampled_ids[i], sampled_log_probs[i])
+                else:
+                    candidate = built[i]
+
                 # update candidates
                 candidate = update_fn(candidate)
                 if candidate is None:
                     # skip invalid candidates
                     continue
-                elif len(current_beams[idx]) < beam_width:
-                    current_beams[idx].append(candidate)
-                else:
+
+                per_parent[parent] += 1
+                current_beams[idx].append(candidate)
+                parent_rows[idx].append(row_offset + parent)
+                if len(current_beams[idx]) >= beam_width:
                     break
 
             update_info[idx] = len(current_beams[idx])
@@ -1,5 +1,6 @@
 from typing import Any, Callable, Protocol
 
+import numpy as np
 import torch
 from grammar_utils.constrain import Constraint
 
@@ -9,7 +10,12 @@ DecodeFn = Callable[..., tuple[torch.Tensor, dict[str, Any]]]
 # select specific elements for all the kwargs keys given the mask tensor
 MaskSelectFn = Callable[[dict[str, Any], torch.Tensor], dict[str, Any]]
 
-# update specific elements for all the kwargs keys given the mask tensor
+# update specific elements for all the kwargs keys given the mask tensor;
+# the mask lives on the inference device. without caching it holds the
+# batch element index of each active beam; with cache=True in beam_search
+# it holds the decode row each beam's parent occupied in the previous
+# step's decoder batch, so per-beam cached state can be reordered with
+# index_select
 MaskUpdateFn = Callable[[dict[str, Any], dict[str, Any], torch.Tensor], None]
 
 
@@ -32,18 +38,58 @@ class Beam:
             initial_length = len(token_ids)
         self.initial_length = initial_length
         self.info: dict[str, Any] = info or {}
+        # keep running sums so scoring does not re-sum
+        # all log probs on every call
+        self._initial_log_prob = sum(log_probs[:initial_length])
+        self._log_prob = sum(log_probs)
+        self._ids_tensor: torch.Tensor | None = None
+        self._score: float | None = None
 
     def add(self, token_id: int, log_p: float) -> None:
         self.token_ids.append(token_id)
         self.log_probs.append(log_p)
+        self._log_prob += log_p
+        self._score = None
+
+    def score(self, score_fn: "ScoreFn") -> float:
+        # beams are rescored many times during beam search (candidate
+        # sorting, stopping checks, output sorting), cache the score
+        # until the beam changes
+        if self._score is None:
+            self._score = score_fn(self)
+        return self._score
 
     def clone(self) -> "Beam":
-        return Beam(
-            self.token_ids.copy(),
-            self.log_probs.copy(),
-            self.info.copy(),
-            self.initial_length,
-        )
+        # beams are cloned once per candidate per decoding step,
+        # so skip __init__ and its validation entirely
+        beam = Beam.__new__(Beam)
+        beam.token_ids = self.token_ids.copy()
+        beam.log_probs = self.log_probs.copy()
+        beam.initial_length = self.initial_length
+        beam.info = self.info.copy()
+        beam._initial_log_prob = self._initial_log_prob
+        beam._log_prob = self._log_prob
+        beam._score = self._score
+        # the cached tensor is never mutated in place,
+        # so it can be shared with the clone
+        beam._ids_tensor = self._ids_tensor
+        return beam
+
+    def ids_tensor(self) -> torch.Tensor:
+        # cache the token id tensor and extend it incrementally,
+        # rebuilding it from the Python list on every decoding step
+        # would be quadratic in the sequence length
+        num = len(self.token_ids)
+        if self._ids_tensor is None:
+            self._ids_tensor = torch.tensor(self.token_ids, dtype=torch.long)
+        elif len(self._ids_tensor) < num:
+            self._ids_tensor = torch.cat([
+                self._ids_tensor,
+                torch.tensor(
+                    self.token_ids[len(self._ids_tensor):], dtype=torch.long
+                )
+            ])
+        return self._ids_tensor
 
     @property
     def initial_token_ids(self) -> list[int]:
@@ -67,11 +113,11 @@ class Beam:
 
     @property
     def log_prob(self) -> float:
-        return sum(self.log_probs)
+        return self._log_prob
 
     @property
     def decoded_log_prob(self) -> float:
-        return sum(self.decoded_log_probs)
+        return self._log_prob - self._initial_log_prob
 
     @property
     def decoded_length(self) -> int:
@@ -102,15 +148,15 @@ LogitFn = Callable[
 ]
 
 # takes in log probs and beam width and returns
-# beam width samples
+# beam width samples per beam
 SampleFn = Callable[
     [
-        # distribution over next tokens, shape [vocab_size]
+        # distribution over next tokens, shape [num_beams, vocab_size]
         torch.Tensor,
         # beam width
         int,
     ],
-    # indices of selected tokens, shape [<= beam_width]
+    # indices of selected tokens, shape [num_beams, <= beam_width]
     torch.Tensor,
 ]
 
@@ -143,20 +189,43 @@ class ScoreFn(Protocol):
     def __call__(self, beam: Beam, length: int | None = None) -> float: ...
 
 
-def log_likelihood_score(normalize: bool = True, alpha: float = 1.0) -> ScoreFn:
-    assert alpha >= 0.0, "alpha must be positive"
+class LogLikelihoodScore:
+    # for beams of equal decoded length this score is monotone in the
+    # decoded log prob, which beam search exploits to rank candidates
+    # without building a Beam per candidate
+    monotone_in_log_prob = True
 
-    def _score(beam: Beam, length: int | None = None) -> float:
+    def __init__(self, normalize: bool = True, alpha: float = 1.0) -> None:
+        assert alpha >= 0.0, "alpha must be positive"
+        self.normalize = normalize
+        self.alpha = alpha
+
+    def __call__(self, beam: Beam, length: int | None = None) -> float:
         log_prob = beam.decoded_log_prob
         if length is None:
             length = beam.decoded_length
 
-        if normalize and length > 0:
-            return log_prob / (length**alpha)
+        if self.normalize and length > 0:
+            return log_prob / (length**self.alpha)
         else:
             return log_prob
 
-    return _score
+    def batch(self, beams: list[Beam]) -> np.ndarray:
+        # score many beams in one vectorized pass instead of one
+        # Python call per beam
+        log_probs = np.array([beam.decoded_log_prob for beam in beams])
+        if not self.normalize:
+            return log_probs
+        # unnormalized score for beams without decoded tokens,
+        # same as the scalar path
+        lengths = np.maximum(
+            [beam.decoded_length for beam in beams], 1
+        ).astype(np.float64)
+        return log_probs / lengths**self.alpha
+
+
+def log_likelihood_score(normalize: bool = True, alpha: float = 1.0) -> ScoreFn:
+    return LogLikelihoodScore(normalize, alpha)
 
 
 def constraint_logit_fn(
@@ -215,8 +284,14 @@ def identity_update_fn() -> UpdateFn:
 
 def sample() -> SampleFn:
     def _sample(logits: torch.Tensor, k: int) -> torch.Tensor:
-        assert logits.ndim == 1, "expected logits to be 1D"
-        k = min(k, logits.shape[-1] - torch.isneginf(logits).sum().item())
+        assert logits.ndim == 2, "expected logits to be 2D"
+        # sample the full k for every row, even rows whose support is
+        # smaller; multinomial then pads with zero-probability indices,
+        # which carry -inf log prob and are filtered out by beam_search.
+        # clamping k by the most restricted row instead would let one
+        # heavily constrained beam collapse the candidate counts of all
+        # other beams in the batch (and would force a device sync)
+        k = min(k, logits.shape[-1])
         probs = torch.softmax(logits, dim=-1)
         return torch.multinomial(probs, k)
 
@@ -225,8 +300,11 @@ def sample() -> SampleFn:
 
 def greedy() -> SampleFn:
     def _greedy(logits: torch.Tensor, k: int) -> torch.Tensor:
-        assert logits.ndim == 1, "expected logits to be 1D"
-        k = min(k, logits.shape[-1] - torch.isneginf(logits).sum().item())
+        assert logits.ndim == 2, "expected logits to be 2D"
+        # counting the -inf logits here would force a device sync;
+        # select the top k unconditionally instead, beam_search
+        # filters out selections with -inf log prob afterwards
+        k = min(k, logits.shape[-1])
         return torch.topk(logits, k, dim=-1).indices
 
     return _greedy
@@ -1,11 +1,25 @@
 import copy
 from typing import Dict, Any, List, Optional, Callable
 
-import einops
 import torch
 from torch import nn
 
 
+@torch.jit.script
+def _focal_term(
+    ce: torch.Tensor,
+    log_pt: Optional[torch.Tensor],
+    gamma: float
+) -> torch.Tensor:
+    # scripted so the element-wise ops are fused into
+    # a single kernel instead of one launch per op
+    if log_pt is None:
+        pt = torch.exp(-ce)
+    else:
+        pt = log_pt.exp()
+    return torch.pow((1.0 - pt).clamp_(0.0, 1.0), gamma) * ce
+
+
 class FocalLoss(nn.Module):
     # copied and modified from https://github.com/AdeelH/pytorch-multi-class-focal-loss/blob/master/focal_loss.py
     def __init__(
@@ -16,12 +30,19 @@ class FocalLoss(nn.Module):
         ignore_index: int = -100,
     ):
         super().__init__()
-        self.alpha = alpha
+        # keep alpha as a (non-persistent) buffer so it moves with the
+        # module on .to(device) instead of being copied host to device
+        # on every forward; shared with the wrapped nll loss
+        self.register_buffer(
+            "alpha",
+            torch.as_tensor(alpha, dtype=torch.float) if alpha is not None else None,
+            persistent=False
+        )
         self.gamma = gamma
         self.reduction = reduction
         self.ignore_index = ignore_index
         self.nll_loss = nn.NLLLoss(
-            weight=torch.as_tensor(alpha, dtype=torch.float) if alpha is not None else None,
+            weight=self.alpha,
             reduction="none",
             ignore_index=ignore_index
         )
@@ -35,20 +56,24 @@ class FocalLoss(nn.Module):
         labels = labels.long()
         unignored_mask = labels != self.ignore_index
         labels = labels[unignored_mask]
-        if len(labels) == 0:
-            return torch.tensor(0, device=outputs.device, dtype=torch.float)
         outputs = outputs[unignored_mask]
 
         log_p = torch.log_softmax(outputs, dim=-1)
         ce = self.nll_loss(log_p, labels)
 
-        log_pt = log_p[torch.arange(len(outputs), device=outputs.device), labels]
-        pt = log_pt.exp()
-        focal_term = torch.pow((1 - pt).clamp(0, 1), self.gamma)
-        ce = focal_term * ce
+        if self.alpha is None:
+            # without class weights ce is exactly -log_pt, so we can
+            # avoid a second gather over the [N, C] log probs
+            log_pt = None
+        else:
+            log_pt = log_p[torch.arange(len(outputs), device=outputs.device), labels]
+        ce = _focal_term(ce, log_pt, self.gamma)
 
         if self.reduction == "mean":
-            ce = ce.mean()
+            # sum over a clamped count instead of mean so that inputs
+            # without unignored labels give a zero loss instead of nan,
+            # keeping the computation fully on device
+            ce = ce.sum() / unignored_mask.sum().clamp_min(1)
         elif self.reduction == "sum":
             ce = ce.sum()
         return ce
@@ -66,9 +91,9 @@ class SeqLoss(nn.Module):
 
     def forward(self, outputs: torch.Tensor, labels: torch.Tensor) -> torch.Tensor:
         # outputs are expected to be of shape [B, S, C], reshape to [B * S, C]
-        outputs = einops.rearrange(outputs, "b s c -> (b s) c")
+        outputs = outputs.reshape(-1, outputs.size(-1))
         # labels are expected to be of shape [B, S], reshape to [B * S]
-        labels = einops.rearrange(labels, "b s -> (b s)")
+        labels = labels.reshape(-1)
         return self.loss(outputs, labels)
 
 
@@ -84,13 +109,11 @@ class MultiLayerLoss(nn.Module):
 
     def forward(self, outputs: torch.Tensor, labels: torch.Tensor) -> torch.Tensor:
         # outputs are expected to be of shape [L, B, ...] reshape to [L * B, ...]
-        num_layers, batch_size = outputs.shape[:2]
-        shape = outputs.shape[2:]
-        outputs = outputs.reshape(num_layers * batch_size, *shape)
+        num_layers = outputs.shape[0]
+        outputs = torch.flatten(outputs, 0, 1)
         # labels are expected to be of shape [B, ...] repeat to [L * B, ...]
-        dim = labels.ndim
-        shape = labels.shape[1:]
-        labels = labels.unsqueeze(0).repeat(*([num_layers] + [1] * dim)).reshape(num_layers * batch_size, *shape)
+        labels = labels.unsqueeze(0).repeat(num_layers, *([1] * labels.ndim))
+        labels = torch.flatten(labels, 0, 1)
         return self.loss(outputs, labels)
 
 